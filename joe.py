@@ -10,14 +10,37 @@ import functools
 import itertools
 import random
 import math
-import marshal
+import collections
 import cmd
 import re
-from pprint import pprint
+import timeit
+import pickle
+import atexit
+import multiprocessing
+import multiprocessing.pool
+import contextvars
+import types
+import asyncio
+import concurrent.futures
+import threading
+import json
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 version = "0.2.0"
 MAXRANK = 100
 DEBUG = False
+TRAINS = 'vm' # 'vm' or 'closures'
+ARRAYS = 256 # Minimum length of a list to be handled with NumPy
+CACHESIZE = 4096 # Default number of entries kept by each memo cache
+MEMOIZE = False # Memoize pure user-defined functions
+PROCESSES = 0 # Worker processes for mapping over long lists (0 maps serially)
+PARALLEL = 1024 # Minimum length of a list to be mapped in parallel
+arraytypes = (numpy.ndarray,) if numpy else ()
 
 def debugprint(type, text):
     """Used to print debug-statements."""
@@ -29,8 +52,38 @@ tests = [("""{/+%N)1 2 3 4""", 2.5), # Median
          ("""(2Lr0 1/v;$l/+@2ER)10""", [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]), # Fibonacci sequence
          ("""(VO$rME{M;C)$r-u)"dsaasafd" """, [['a', 3], ['s', 2], ['d', 2], ['f', 1]]), # Counting occurences
          ("""M-l~/!R5""", [[1], [1, 1], [1, 2, 1], [1, 3, 3, 1], [1, 4, 6, 4, 1]]), # Pascal triangle
+         ("""/+1+R1000""", 500500), # Sum of a long range
+         ("""/>c1.0 0 1""", 1.0), # Fold keeps the leftmost maximum
+         ("""\\/>c3 1 4 1 5""", [3, 3, 4, 4, 5]), # Running maximum
+         ("""/+2*1+R100000""", 10000100000), # Arithmetic on a lazy range
+         ("""V"-"J" "S"ro  eb ot" """, list("to-be--or")), # Splitting and joining text
+         ("""1 2=,1 2 1 2 3""", [1, 0, 1, 0, 0]), # Where 1 2 starts
+         ("""KN"dsaasafd" """, [2, 2, 3, 1]), # Counting occurences by key
+         ("""1 2 1K/+10 20 30""", [40, 20]), # Sums by key
+         ("""Gd 3 1 3 2""", [0, 2, 3, 1]), # Grading keeps ties in order
+         ("""("abc"=1+)5""", [0, 0, 0]), # Trains don't fuse steps bound to text
+         ("""(1+"ab"=)8""", [1, 1]),
+         ("""{1+(R300)+)5""", list(range(6, 306))), # Nor steps bound to lazy ranges
+         ("""(1+(R300)+2*)5""", list(range(11, 311))),
+         ("""N;p((R300)%2)(1 2)""", 302), # Arrays and ranges inside lists
+         ("""NHPe((R300)%2)(1 2)""", 300),
+         ("""HHO((R300)%3)((R300)%2)""", 0.0),
+         ("""HHO(1+R300)(R300)""", 0),
          ]
 
+benchmarks = ["""{/+%N)R10000""",
+              """(1+2*1+2*1+)R10000""",
+              """M(1+2*1+2*1+)R10000""",
+              """M{1+*2-*1+)R3000""",
+              """1+25]R5""", # Dispatch cost per level of nesting should stay
+              """1+50]R5""", # the same regardless of the depth.
+              """1+100]R5""",
+              """/+%1+R100000""",
+              """\\/+%1+R100000""",
+              """N"ab"S 30000T"xab" """,
+              """/+"ab"=,30000T"xab" """,
+              ]
+
 code = '~/*1R10'
 
 whitespace = ' \t'
@@ -65,70 +118,359 @@ def unescape(text): # Taken somewhere from Stack Overflow
         return bytes((v, ))
     return regex.sub(replace, text)
 
-def memoize(f): 
-    """Memoize any function.
-       Be careful about the memory footprint."""
-    cache = {}
-    def decorated(*args):
-        key = marshal.dumps(args)
-        if key in cache:
-            return cache[key]
-        r = f(*args)
-        cache[key] = r
-        return r
-    return decorated
+def freeze(v):
+    """Make a hashable key of a value. Lists become tuples, bools and floats
+       are tagged with their type since they compare equal to ints."""
+    t = type(v)
+    if t is int or t is str:
+        return v
+    if isinstance(v, (list, tuple) + lazytypes):
+        return tuple(map(freeze, v))
+    if isinstance(v, arraytypes):
+        return freeze(v.tolist())
+    if t is bool or t is float:
+        return (t, v)
+    return v
+
+def hashed(v):
+    """Make a hashable key of a value. Unlike freeze, equal values always
+       get equal keys: lists, ranges, views and texts all become tuples."""
+    if type(v) in atoms:
+        return v
+    if isinstance(v, arraytypes):
+        v = v.tolist()
+    if isinstance(v, (list, tuple) + lazytypes):
+        return tuple(map(hashed, v))
+    return v
+
+caches = {} # The caches every interpreter gets a copy of
+
+class Cache:
+    """A memo table keeping at most size entries (None for no limit), which
+       evicts the least recently used ones. Decorate a function with it to
+       memoize the function, with a table of its own in each interpreter.
+       Arguments are frozen to keys if freeze is set, otherwise they have to
+       be hashable."""
+    def __init__(self, name, size=CACHESIZE, freeze=False):
+        self.name = name
+        self.size = size
+        self.freeze = freeze
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, f):
+        caches[self.name] = self
+        return self.wrap(f, lambda: current.get().cache(self))
+
+    def wrap(self, f, table):
+        """Memoize f in the cache table() returns."""
+        def cached(*args):
+            c = table()
+            entries = c.entries
+            key = freeze(args) if c.freeze else args
+            try:
+                r = entries[key]
+            except KeyError:
+                c.misses += 1
+            else:
+                entries.move_to_end(key)
+                c.hits += 1
+                return r
+            r = f(*args)
+            if c.size != 0:
+                entries[key] = r
+                c.trim()
+            return r
+        cached.cache = self
+        return cached
+
+    def copy(self):
+        """An empty cache with the same settings."""
+        return Cache(self.name, self.size, self.freeze)
+
+    def trim(self):
+        while self.size is not None and len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, size):
+        self.size = size
+        self.trim()
 
-def memoizef(f):
+    def clear(self):
+        self.entries.clear()
+
+    def discard(self, *args):
+        """Forget the entry for args, if there is one."""
+        self.entries.pop(freeze(args) if self.freeze else args, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "%s: %d/%s entries, %d hits, %d misses, %d evictions" % (
+            self.name, len(self), 'inf' if self.size is None else self.size,
+            self.hits, self.misses, self.evictions)
+
+def memoize(f, name=None):
+    """Memoize any function, keyed by frozen copies of its arguments."""
+    return Cache(name or f.__name__, freeze=True)(f)
+
+def memoizef(f, name=None):
     """Memoize a function accepting only hashable arguments."""
-    cache = {}
-    def deco(*args):
-        key = tuple(args)
-        if key in cache:
-            return cache[key]
-        r = f(*args)
-        cache[key] = r
-        return r
-    return deco
+    return Cache(name or f.__name__)(f)
+
+def clearcaches():
+    """Empty every cache of the running interpreter."""
+    for c in current.get().caches.values():
+        c.clear()
+
+def sizecaches(size, freezing=None):
+    """Set the size of every memo cache of the running interpreter, or only
+       of the ones (not) freezing their arguments. Resizing the caches of
+       the default interpreter resizes the ones new interpreters copy too."""
+    interpreter = current.get()
+    for c in itertools.chain(interpreter.caches.values(),
+                             caches.values() if interpreter is parser else ()):
+        if c.name != 'compile' and freezing in (None, c.freeze):
+            c.resize(size)
+
+class Exhausted(RuntimeError):
+    """Raised when an evaluation goes over a budget of its Governor."""
+
+class Governor:
+    """Budgets for an evaluation: at most calls calls of call(), elements
+       list items allocated and seconds of wall-clock time (None for no
+       limit). The calls made and items allocated are counted, whether or
+       not there's a limit. Set one as the governor of an interpreter to
+       have the lines it runs checked against it."""
+    def __init__(self, calls=None, elements=None, seconds=None):
+        self.maxcalls = calls
+        self.maxelements = elements
+        self.seconds = seconds
+        self.calls = self.elements = 0
+        self.start = time.perf_counter()
+        self.deadline = None if seconds is None else self.start + seconds
+
+    def step(self):
+        self.calls += 1
+        if self.maxcalls is not None and self.calls > self.maxcalls:
+            raise Exhausted("Over the budget of %d calls" % self.maxcalls)
+        self.check()
+
+    def allocate(self, n):
+        self.elements += n
+        if self.maxelements is not None and self.elements > self.maxelements:
+            raise Exhausted("Over the budget of %d elements" % self.maxelements)
+        self.check()
+
+    def check(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise Exhausted("Over the budget of %g seconds" % self.seconds)
+
+    def used(self):
+        """The calls, elements and seconds used so far."""
+        return {'calls': self.calls, 'elements': self.elements,
+                'seconds': time.perf_counter() - self.start}
+
+governing = set() # The governors of the evaluations running now
+
+def allocate(n):
+    """Count n list items about to be allocated against the budget of the
+       running interpreter, if it has one."""
+    if governing:
+        governor = current.get().governor
+        if governor is not None:
+            governor.allocate(n)
+
+class Array(list):
+    """A list which carries its depth, so it doesn't need to be recomputed
+       on every level of call()."""
+    __slots__ = ('depth',)
+
+def shaped(l):
+    """Make an Array of a list. The depth is taken from the first item."""
+    a = Array(l)
+    if governing:
+        allocate(len(a))
+    a.depth = (len(a) and depth(a[0])) + 1
+    return a
+
+class View:
+    """A slice of a list that shares the list instead of copying it. Like
+       ranges, views are given as they are to functions flagged seq, and
+       call() makes lists of them for the rest."""
+    __slots__ = ('base', 'indices')
+
+    def __init__(self, base, indices):
+        self.base = base
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return cut(self, i)
+        return self.base[self.indices[i]]
+
+    # Iterating a short lived copy is faster than indexing the base, and
+    # only one is alive at a time.
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __reversed__(self):
+        return reversed(self.tolist())
+
+    def __eq__(self, other):
+        return self.tolist() == (other.tolist() if type(other) is View else other)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def tolist(self):
+        r = self.indices
+        if r.step > 0:
+            return self.base[r.start:r.stop:r.step]
+        return list(map(self.base.__getitem__, r))
+
+class Text(str):
+    """Character data packed in a str instead of a list of characters. Like
+       views, texts are given as they are to functions flagged seq, and
+       call() makes lists of them for the rest. A text equals the list of
+       its characters, but not a single character."""
+    __slots__ = ()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Text(str.__getitem__(self, i))
+        return str.__getitem__(self, i)
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return type(other) is Text and str.__eq__(self, other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return str.__lt__(self, other) if type(other) is Text else list(self) < other
+
+    def __le__(self, other):
+        return str.__le__(self, other) if type(other) is Text else list(self) <= other
+
+    def __gt__(self, other):
+        return str.__gt__(self, other) if type(other) is Text else list(self) > other
+
+    def __ge__(self, other):
+        return str.__ge__(self, other) if type(other) is Text else list(self) >= other
+
+    __hash__ = str.__hash__
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def tolist(self):
+        return list(self)
+
+def textual(v):
+    """Tells if a value is a text or a list of single characters."""
+    return type(v) is Text or isinstance(v, list) and all(type(z) is str and len(z) == 1 for z in v)
+
+lazytypes = (range, View, Text)
+
+def cut(x, s):
+    """Slice a list, range or view. Long slices of lists are views."""
+    if type(x) is View:
+        v = View(x.base, x.indices[s])
+        return v if len(v) >= ARRAYS else v.tolist()
+    if isinstance(x, list):
+        r = range(len(x))[s]
+        if len(r) >= ARRAYS:
+            return View(x, r)
+    return x[s]
 
-usermemoize = memoizef
+def depth(x):
+    """Resolve the depth of a list."""
+    if type(x) is Array:
+        return x.depth
+    if isinstance(x, arraytypes):
+        return x.ndim
+    return isinstance(x, (list, tuple) + lazytypes) and (len(x) and depth(x[0])) + 1
 
-# Resolve the depth of a list
-depth = lambda x: isinstance(x, (list, tuple)) and (len(x) and depth(x[0])) + 1
-# Fold from the right
-foldr = lambda f, xs, s=None: (functools.reduce(f, reversed(xs[:-1] if s is None else xs), xs[-1] if s is None else s) if len(xs) else [])
 # Flip the arguments of a function
 flip  = lambda f: rank(lambda x, y=None: f(y, x), (f.rank[0], f.rank[2], f.rank[1]))
 # Bind the left argument of a function.
-bind  = lambda f, x: rank(lambda y, _=None: call(f, x, y), MAXRANK)
+bind  = lambda f, x: rank(lambda y, _=None: call(f, x, y), MAXRANK, seq=True)
 # Combine two functions into one.
 #  combine(f, g)(1)    == f(g(1))
 #  combine(f, g)(1, 2) == f(2, g(2, 1))
 combine = lambda f, g: rank(lambda x, y=None: (call(f, call(g, x))
                                                if y is None
                                                else call(f, y, call(g, y, x))),
-                            MAXRANK)
+                            MAXRANK, seq=True)
 # Cobbines three functions to a fork.
 # 
 fork = lambda f, g, h: rank(lambda x, y=None: (call(g, call(f, x), call(h, x))
                                                 if y is None
                                                 else call(g, call(f, y, x), call(h, y, x))),
-                             MAXRANK)
-
-def rank(f, r, p=(0, 0, 0)):
-    """Set the rank of a function."""
-    if not isinstance(r, (tuple, list)):
-        r = (r, r, r)
-    elif len(r) == 1:
-        r = (r[0], r[0], r[0])
-    elif len(r) == 2:
-        r = (r[1], r[0], r[1])
-    f.rank = r
-    f.pad = p
-    return f
+                             MAXRANK, seq=True)
+
+class Function:
+    """A Joe function. Monad and dyad are the implementations (the dyad takes
+       the right argument first), rank and pad are (monad, left, right)
+       triples. Pure functions have no side effects, associative ones can be
+       folded in any grouping. Seq functions take lazy ranges and arrays
+       functions take NumPy arrays as they are, instead of getting lists.
+       Over is the function a fold folds with. Grows is set for functions
+       which add to the end of their right argument, see grow(). Recipe is
+       how the function was built, so it can be rebuilt in another process."""
+    __slots__ = ('monad', 'dyad', 'rank', 'pad', 'pure', 'assoc', 'seq', 'arrays', 'over', 'name',
+                 'lifts', 'grows', 'recipe')
+
+    def __init__(self, f, r=MAXRANK, p=(0, 0, 0), dyad=None, pure=True, assoc=False, seq=False,
+                 arrays=False, over=None, name=None, grows=None):
+        if not isinstance(r, (tuple, list)):
+            r = (r, r, r)
+        elif len(r) == 1:
+            r = (r[0], r[0], r[0])
+        elif len(r) == 2:
+            r = (r[1], r[0], r[1])
+        self.monad = f
+        self.dyad = dyad or f
+        self.rank = tuple(r)
+        self.pad = p
+        self.pure = pure
+        self.assoc = assoc
+        self.seq = seq
+        self.arrays = arrays
+        self.over = over
+        self.name = name
+        self.lifts = {}
+        self.grows = grows
+        self.recipe = None
+
+    def __call__(self, x, y=None):
+        return self.monad(x) if y is None else self.dyad(x, y)
+
+    def __reduce__(self):
+        if self.recipe:
+            return (build, self.recipe)
+        if primitives.get(self.name) is self:
+            return (build, ('primitive', self.name))
+        raise pickle.PicklingError('%r can not be rebuilt' % self)
+
+    def __repr__(self):
+        return '<function %s>' % (self.name or hex(id(self)))
+
+def rank(f, r, p=(0, 0, 0), **flags):
+    """Make a function with the given rank and padding."""
+    return Function(f, r, p, **flags)
 def rankof(f):
     """Resolve the rank of a function."""
     f = resolve(f)
-    if hasattr(f, 'rank'):
+    if isinstance(f, Function):
         return f.rank
     return (MAXRANK, MAXRANK, MAXRANK)
 def applyN(f, n, x, y):
@@ -138,22 +480,21 @@ def applyN(f, n, x, y):
     return x
 def padrank(f):
     """Resolves the padding rank of a function."""
-    try:
+    if isinstance(f, Function):
         return f.pad
-    except:
-        return (0, 0, 0)
+    return (0, 0, 0)
 def resolve(x):
     """Resolves the value from a data-tuple."""
     if isinstance(x, tuple):
         if x[0] == 'function':
             if isinstance(x[1], str):
-                x = functions[x[1]]
+                x = current.get().functions[x[1]]
             else:
                 x = x[1]
         elif x[0] in ('value', 'list'):
             x = x[1]
         elif x[0] == 'variable':
-            x = variables[x[1]]
+            x = current.get().variables[x[1]]
         else:
             raise Exception('Unexpected tuple ' + str(x) + ' - blame the developer')
     return x
@@ -178,28 +519,74 @@ def adjust(l):
 def nest(x, n):
     """Nests the list/value n times."""
     for _ in range(n):
-        x = [x]
+        x = shaped([x])
     return x
 
+def occurrences(l, sub):
+    """Yields where sub starts in l, overlapping occurrences included. Texts
+       are searched with str.find, other lists with Knuth-Morris-Pratt."""
+    m = len(sub)
+    if not m:
+        yield from range(len(l) + 1)
+    elif type(l) is Text and textual(sub):
+        sub = ''.join(sub)
+        i = l.find(sub)
+        while i >= 0:
+            yield i
+            i = l.find(sub, i + 1)
+    else:
+        sub = tolist(sub)
+        fail = [0] * m
+        k = 0
+        for i in range(1, m):
+            while k and sub[i] != sub[k]:
+                k = fail[k-1]
+            if sub[i] == sub[k]:
+                k += 1
+            fail[i] = k
+        k = 0
+        for i, z in enumerate(l):
+            while k and z != sub[k]:
+                k = fail[k-1]
+            if z == sub[k]:
+                k += 1
+                if k == m:
+                    yield i - m + 1
+                    k = fail[k-1]
+
+def matches(l, sub):
+    """Marks where sub starts in l with 1. The last m positions are always 0."""
+    n, m = len(l), len(sub)
+    r = [0] * (max(n - m, 0) + m)
+    for i in occurrences(l, sub):
+        if i >= n - m:
+            break
+        r[i] = 1
+    return r
+
 def split(l, splitter):
-    """Split the list at the splitter. Splitter should be a list of values."""
-    sl = len(splitter)
+    """Split the list at the splitter. Splitter should be a list of values.
+       Texts split at textual splitters natively."""
+    if not len(splitter):
+        raise ValueError("Empty splitter")
+    if type(l) is Text and textual(splitter):
+        r = [Text(z) for z in l.split(''.join(splitter))]
+        return r if r[-1] else r[:-1]
+    l = tolist(l)
     r = []
-    curr = []
-    while len(l):
-        if l[:sl] == splitter:
-            r += [curr]
-            curr = []
-            l = l[sl:]
-        else:
-            curr += [l[0]]
-            l = l[1:]
-    if len(curr) > 0:
-        r += [curr]
+    i = 0
+    for j in occurrences(l, splitter):
+        if j >= i:
+            r += [l[i:j]]
+            i = j + len(splitter)
+    if i < len(l):
+        r += [l[i:]]
     return r
 
 def join(l, j):
-    """Joins the items of l with j."""
+    """Joins the items of l with j. Texts joined with a textual j stay texts."""
+    if j and textual(j) and all(type(x) is Text for x in l):
+        return Text(''.join(j).join(l))
     r = []
     for x in l:
         r += x
@@ -209,7 +596,7 @@ def join(l, j):
 def unique(l, idfun=None):
     """Select unique items from a list, optionally using a selector function."""
     if idfun is None:
-        idfun = lambda x: x
+        idfun = hashed
     seen = {}
     result = []
     for item in l:
@@ -219,6 +606,81 @@ def unique(l, idfun=None):
         result.append(item)
     return result
 
+def difference(l, y):
+    """Items of l which are not in y."""
+    s = set(map(hashed, y))
+    return [z for z in l if hashed(z) not in s]
+
+def intersection(l, y):
+    """Items of l which are in y."""
+    s = set(map(hashed, y))
+    return [z for z in l if hashed(z) in s]
+
+def count(l, y):
+    """Count the items of l equal to y, or to each item of y if it's a list.
+       Counting many items indexes l only once."""
+    if not depth(y):
+        return sum(1 for z in l if z == y)
+    c = collections.Counter(map(hashed, l))
+    return shaped([c[hashed(z)] for z in y])
+
+def key(f, x, y=None):
+    """Apply f to each group of equal items of x, in the order the groups
+       first appear. With y, the items of x are grouped by the items of y.
+       Counting the groups with N skips making them."""
+    keys = x if y is None else y
+    if len(keys) != len(x):
+        raise ValueError("Key and item counts differ: %d and %d" % (len(keys), len(x)))
+    if resolve(f) is primitives['N']:
+        return list(collections.Counter(map(hashed, keys)).values())
+    groups = {}
+    for k, z in zip(keys, x):
+        groups.setdefault(hashed(k), []).append(z)
+    return shaped([call(f, g) for g in groups.values()])
+
+def comparable(v):
+    """A key ordering v like its plain list would be: the ranges, views and
+       arrays in it become lists, since < doesn't work on them."""
+    if isinstance(v, arraytypes):
+        return v.tolist()
+    if type(v) is range or type(v) is View:
+        return comparable(list(v))
+    if isinstance(v, list) and not set(map(type, v)) <= flattypes:
+        return list(map(comparable, v))
+    return v
+
+def grade(l, down=False):
+    """The indices which sort l, keeping equal items in order (a stable
+       argsort). Long numeric lists are graded with NumPy."""
+    a = array(l) if numpy and big(l) else None
+    if a is not None and numpy.ndim(a) == 1:
+        if down:
+            return len(a) - 1 - numpy.argsort(a[::-1], kind='stable')[::-1]
+        return numpy.argsort(a, kind='stable')
+    return sorted(range(len(l)), key=comparable(l).__getitem__, reverse=down)
+
+def gather(l, indices):
+    """The items of l at the indices."""
+    if isinstance(indices, arraytypes):
+        a = array(l)
+        if a is not None and numpy.ndim(a) == 1:
+            return a[indices]
+        indices = indices.tolist()
+    return [l[i] for i in indices]
+
+def sort(l):
+    """Sort l, with NumPy if it's a long numeric list."""
+    a = array(l) if numpy and big(l) else None
+    if a is not None and numpy.ndim(a) == 1:
+        return numpy.sort(a, kind='stable')
+    return sorted(l, key=comparable)
+
+def sortby(l, keys, i):
+    """Sort l by the first (i is 0) or last (i is -1) items of the items of
+       keys, like H or E would give."""
+    return gather(l, grade([z[i] if isinstance(z, (list,) + lazytypes + arraytypes) and len(z) else z
+                            for z in keys]))
+
 def int2base(x, base):
     """Convert an integer to a different base."""
     basel = len(base)
@@ -253,8 +715,10 @@ def base2int(l, base):
 
 def padarray(l, lr=0, padder=0):
     """Pad a list to vbe rectangular (does not adjust the depth)."""
-    l = [x if isinstance(x, list) else [x] for x in l]
-    w = max(len(x) for x in l)
+    w = max(len(x) if isinstance(x, (list,) + lazytypes + arraytypes) else 1 for x in l)
+    allocate(len(l) * w)
+    l = [x.tolist() if isinstance(x, arraytypes) else
+         list(x) if isinstance(x, (list,) + lazytypes) else [x] for x in l]
     if lr == 0:
         return [[padder]*(w-len(x))+x for x in l]
     else:
@@ -270,42 +734,144 @@ def combinations(n, r):
 
 def windows(l, w):
     """Takes windows of width w from the given list.
-       If the width is negative, the windows won't overlap. May cause the last window to be smaller."""
+       If the width is negative, the windows won't overlap. May cause the last window to be smaller.
+       Wide windows are views into the list (or NumPy array) rather than copies."""
     i = 0
     ll = len(l)
     r = []
+    if isinstance(l, arraytypes) and abs(w) < ARRAYS:
+        l = l.tolist()
     if w > 0:
         while i < ll - w + 1:
-            r += [l[i:i+w]]
+            r += [cut(l, slice(i, i+w))]
             i += 1
     else:
         w = -w
         while i < ll - w:
-            r += [l[i:i+w]]
+            r += [cut(l, slice(i, i+w))]
             i += w
         if i < ll:
-            r += [l[i:]]
+            r += [cut(l, slice(i, None))]
     return r
 
+def fold(f, xs, s=None):
+    """Fold f from the right over xs, starting from s or the last element.
+       Associative primitives with a known reduction skip the per element
+       calls."""
+    if not len(xs):
+        return []
+    f = resolve(f)
+    if s is None and len(xs) == 1:
+        return xs[0]
+    if f in reducers:
+        flat, whole = reducers[f]
+        v = None
+        if isinstance(xs, arraytypes):
+            if whole and s is None and xs.size >= ARRAYS:
+                v = whole(xs)
+            if v is None:
+                # Still faster than calling f for each item.
+                allocate(xs.size)
+                xs = xs.tolist()
+        if v is None:
+            v = flat(xs if s is None else [*xs, s])
+        if v is not None:
+            return v
+    if isinstance(xs, arraytypes):
+        allocate(xs.size)
+        xs = xs.tolist()
+    if isinstance(f, Function) and f.grows:
+        return grow(f, xs, s)
+    if s is None:
+        s = xs[-1]
+        xs = itertools.islice(reversed(xs), 1, None)
+    else:
+        xs = reversed(xs)
+    for z in xs:
+        s = call(f, z, s)
+    return s
+
+def growing(f, g):
+    """The grows of a function calling f with its right argument on the left:
+       ~f when g is None, f$lg otherwise. Only ; and +l grow."""
+    try:
+        f = resolve(f)
+    except KeyError: # Not defined yet
+        return None
+    return (f, g) if f is primitives[';'] or f is primitives['+l'] else None
+
+def grow(f, xs, s=None):
+    """Fold with a function which adds to the end of the accumulator, like
+       ~; or +l$lG. Instead of copying the accumulator at every step, it is
+       one list which is added to in place. G gets a copy of it, or a view
+       when it's long, as the list keeps changing."""
+    f, g = f.grows
+    if s is None:
+        s = xs[-1]
+        xs = itertools.islice(reversed(xs), 1, None)
+    else:
+        xs = reversed(xs)
+    acc = list(tolist(s)) if depth(s) else None
+    for z in xs:
+        if g is not None:
+            z = call(g, z, s if acc is None else
+                           View(acc, range(len(acc))) if len(acc) >= ARRAYS else acc[:])
+        if acc is None:
+            acc = [s]
+        # Only the item itself is unwrapped: its sub-lists may be shared
+        # with the accumulator, so converting them deeply is exponential.
+        if type(z) is View:
+            z = z.tolist()
+        elif type(z) is range or type(z) is Text:
+            z = list(z)
+        if f is primitives['+l'] or not depth(z):
+            acc.append(z)
+        else:
+            acc.extend(z)
+    return acc
+
+def scan(f, x):
+    """Apply f to every prefix of x. When f folds an associative primitive,
+       the prefixes are reduced as running results in a single pass."""
+    g = resolve(f)
+    g = resolve(g.over) if isinstance(g, Function) else None
+    if isinstance(g, Function) and g.assoc and len(x):
+        if isinstance(x, arraytypes):
+            if g in accumulators and x.ndim == 1:
+                r = accumulators[g](x)
+                if r is not None:
+                    return r
+            x = x.tolist()
+        if g.rank != (0, 0, 0):
+            return list(itertools.accumulate(x, lambda a, z: call(g, a, z)))
+        if set(map(type, x)) <= {int, float, bool}:
+            d = g.dyad
+            return list(itertools.accumulate(x, lambda a, z: d(z, a)))
+    return [call(f, x[:i]) for i in range(1, len(x)+1)]
+
 # Please remember: x is the right argument and y is the left one.
 
 adverbs = {'/': # foldr
                 lambda f: rank(lambda x, y=None: \
-                                   foldr(lambda x, y: call(f, y, x), x) \
+                                   fold(f, x) \
                                    if y is None \
                                    else call(f, y, x),
-                               (MAXRANK, MAXRANK, -1), (1, 0, 0)),
+                               (MAXRANK, MAXRANK, -1), (1, 0, 0), seq=True, arrays=True, over=f),
            '~': # flip
-                lambda f: lambda x, y=None: call(f, x, x) if y is None else call(f, x, y),
+                lambda f: rank(lambda x, y=None: call(f, x, x) if y is None else call(f, x, y),
+                               MAXRANK, seq=True, grows=growing(f, None)),
            'M': # map
                 lambda f: rank(lambda x, y=None: call(f, x) if y is None else call(f, y, x),
-                               (-1, -1, -1)),
+                               (-1, -1, -1), seq=True),
            '\\': # apply to windows
-                lambda f: rank(lambda x, y=None: [call(f, x[:i]) for i in range(1, len(x)+1)]
+                lambda f: rank(lambda x, y=None: scan(f, x)
                                                  if y is None
                                                  else [call(f, i) for i in windows(x, y)],
-                               (MAXRANK, 0, MAXRANK), (1, 0, 1)), 
-           }
+                               (MAXRANK, 0, MAXRANK), (1, 0, 1), seq=True, arrays=True),
+           'K': # key
+                lambda f: rank(lambda x, y=None: key(f, x, y),
+                               MAXRANK, (1, 1, 1), seq=True),
+            }
 
 def agendaf(f, a):
     """Creates a conditive function (selects the function to run according to f)."""
@@ -315,406 +881,986 @@ def agendaf(f, a):
         if y is None:
             return call(v, x)
         return call(v, y, x)
-    F.rank = rankof(f)
-    debugprint("Agenda rank", F.rank)
-    return F
+    debugprint("Agenda rank", rankof(f))
+    return rank(F, rankof(f))
 
 conjunctions = {'^': lambda f, n: rank(lambda x, y=None: \
                                            call(f, x) \
                                            if y is None \
                                            else call(f, y, x),
-                                       n),
+                                       n, seq=True),
                 '/v': lambda f, s: rank(lambda x, y=None:
-                                            foldr(lambda x, y: call(f, y, x), x, s)
+                                            fold(f, x, s)
                                             if y is None
                                             else call(f, y, x),
-                                        (MAXRANK, MAXRANK, -1), (1, 0, 1)),
+                                        (MAXRANK, MAXRANK, -1), (1, 0, 1), seq=True),
                 '@': lambda f, g: rank(lambda x, y=None: call(g, call(f, x) if y is None else call(f, y, x)),
-                                       (MAXRANK, MAXRANK, MAXRANK))
+                                       (MAXRANK, MAXRANK, MAXRANK), seq=True)
                                   if not isinstance(resolve(g), list)
                                   else agendaf(f, g),
                 '@r': lambda f, g: rank(lambda x, y=None: call(g, call(f, x) if y is None else call(f, y, x)),
-                                        rankof(f)),
+                                        rankof(f), seq=True),
                 '`': lambda f, g: g+[f] if isinstance(g, list) else [g, f],
-                '$': lambda f, g: lambda x, y=None: call(g, y, call(f, y, x))
-                                                    if y is not None
-                                                    else call(g, x, call(f, x)), 
-                '$r': lambda f, g: lambda x, y=None: call(g, call(f, y, x), y)
-                                                     if y is not None
-                                                     else call(g, call(f, x), x), 
-                '$l': lambda f, g: lambda x, y=None: call(g, x, call(f, y, x))
-                                                     if y is not None
-                                                     else call(g, x, call(f, x)),
+                '$': lambda f, g: rank(lambda x, y=None: call(g, y, call(f, y, x))
+                                                         if y is not None
+                                                         else call(g, x, call(f, x)),
+                                       MAXRANK, seq=True),
+                '$r': lambda f, g: rank(lambda x, y=None: call(g, call(f, y, x), y)
+                                                          if y is not None
+                                                          else call(g, call(f, x), x),
+                                        MAXRANK, seq=True),
+                '$l': lambda f, g: rank(lambda x, y=None: call(g, x, call(f, y, x))
+                                                          if y is not None
+                                                          else call(g, x, call(f, x)),
+                                        MAXRANK, seq=True, grows=growing(g, f)),
                 }
 
 def partition(l, n):
     return [l[i:i+n] for i in range(0, len(l), n)]
 
+def shape(l, dimensions):
+    """table() for a list that already has all the items."""
+    return l if len(dimensions) == 1 else table(l, dimensions)
+
 def table(l, dimensions):
-    d = functools.reduce(lambda x, y: x*y, dimensions)
+    """Reshape l to the given dimensions (innermost first), repeating it if
+       it's too short. Long numeric data becomes one flat NumPy buffer with
+       a strided view of the shape, other data is cut to rows once. Only the
+       items made here are charged: repeats of l, or all of a range or text."""
+    d = math.prod(dimensions)
     if d == 0:
         return []
-    while len(l) < d:
-        l = l + l
-    l = l[:d]
-    for x in dimensions:
+    if numpy and d >= ARRAYS:
+        a = array(l)
+        if isinstance(a, numpy.ndarray):
+            # array() has charged for a range it made into an arange.
+            allocate(max(d - len(a), 0))
+            return (a[:d] if len(a) >= d else numpy.resize(a, d)).reshape(dimensions[::-1])
+    allocate(d if type(l) is range or type(l) is Text else max(d - len(l), 0))
+    l = list(itertools.islice(itertools.cycle(l) if len(l) < d else l, d))
+    for x in dimensions[:-1]:
         l = partition(l, x)
-    return l[0]
+    return l
 
 def flatten(l):
     for el in l:
-        if isinstance(el, list) and not isinstance(el, str):
+        if isinstance(el, arraytypes):
+            el = el.tolist()
+        if isinstance(el, (list,) + lazytypes):
             for sub in flatten(el):
                 yield sub
         else:
             yield el
 
-functions = {'+': lambda x, y=0: y + x,
-             '+l': lambda x, y=[]: y + [x], 
-             '+b': lambda x, y=False: +(x or y), 
-             '-': lambda x, y=None: x-y if y is not None else -x,
-             '*': lambda x, y=None: x * y if y is not None else (x>0)-(x<0),
-             '*b': lambda x, y=False: +(x and y), 
-             '*p': lambda x, y=2: x ** y, 
-             '%': lambda x, y=1: y/x,
-             ';': lambda x, y=None: y+x if y is not None else [z for y in x for z in y],
-             ';p': lambda x, y=None: [y, x] if y is not None else list(flatten(x)),
-             '|': lambda x, y=None: x%y if y is not None else x if x>0 else -x,
-             '<': lambda x, y=0: x>y,
-             '>': lambda x, y=0: x<y,
-             '<e': lambda x, y=0: x>=y, 
-             '>e': lambda x, y=0: x<=y, 
-             '<c': lambda x, y=None: x if y is None else x if x<y else y,
-             '>c': lambda x, y=None: x if y is None else x if x>y else y,
-             '=': lambda x, y=0: +(x==y),
-             '=,': lambda x, y=None: [+(y==x[i:i+len(y)]) for i in range(len(x)-len(y))]+[0]*len(y),
-             '=:': lambda x, y=0: +(x==y),
-             ']': lambda x, y=1: nest(x, y), 
-             '-l': lambda x, y=[0]: [z for z in x if z not in y], 
-             '-u': lambda x, y=None: unique(x) if y is None else [z for z in x if z in y], 
-             '?': lambda x, y=None: table([random.random() for _ in range(foldr(lambda x, y: x*y, x))], x)
-                                    if y is None
-                                    else table([random.uniform(0, y) for _ in range(foldr(lambda x, y: x*y, x))], x), 
-             '!': lambda x, y=None: math.factorial(x)
-                                    if y is None
-                                    else combinations(x, y), 
-             '#': lambda x, y=None: ([z for i, z in zip(y, x) for _ in range(i)]
-                                     if len(y) > 1
-                                     else [z for z in x for _ in range(y)])
-                                    if y is not None
-                                    else [i for i, z in enumerate(x) if z],
-             'A': lambda x, y=None: x,
-             'B': lambda x, y=None: y if y is not None else x,
+primitives = {'+': rank(lambda x, y=0: y + x, 0, assoc=True),
+             '+l': rank(lambda x, y=[]: y + [x], MAXRANK, (0, 1, 0)),
+             '+b': rank(lambda x, y=False: +(x or y), 0, assoc=True),
+             '-': rank(lambda x, y=None: x-y if y is not None else -x, 0),
+             '*': rank(lambda x, y=None: x * y if y is not None else (x>0)-(x<0), 0, assoc=True),
+             '*b': rank(lambda x, y=False: +(x and y), 0, assoc=True),
+             '*p': rank(lambda x, y=2: x ** y, 0),
+             '%': rank(lambda x, y=1: y/x, 0),
+             ';': rank(lambda x, y=None: y+x if y is not None else [z for y in x for z in y],
+                       MAXRANK, (2, 1, 1), assoc=True),
+             ';p': rank(lambda x, y=None: [y, x] if y is not None else list(flatten(x)),
+                        MAXRANK, (1, 0, 0)),
+             '|': rank(lambda x, y=None: x%y if y is not None else x if x>0 else -x, 0),
+             '<': rank(lambda x, y=0: x>y, 0),
+             '>': rank(lambda x, y=0: x<y, 0),
+             '<e': rank(lambda x, y=0: x>=y, 0),
+             '>e': rank(lambda x, y=0: x<=y, 0),
+             '<c': rank(lambda x, y=None: x if y is None else x if x<y else y, 0, assoc=True),
+             '>c': rank(lambda x, y=None: x if y is None else x if x>y else y, 0, assoc=True),
+             '=': rank(lambda x, y=0: +(x==y), 0),
+             '=,': rank(lambda x, y=None: matches(x, y), (1, 1, 1), seq=True),
+             '=:': rank(lambda x, y=0: +(x==y), MAXRANK),
+             ']': rank(lambda x, y=1: nest(x, y), (MAXRANK, 0, MAXRANK)),
+             '-l': rank(lambda x, y=[0]: difference(x, y), MAXRANK, (1, 1, 1)),
+             '-u': rank(lambda x, y=None: unique(x) if y is None else intersection(x, y),
+                        MAXRANK, (1, 1, 1)),
+             '?': rank(lambda x, y=None: allocate(math.prod(x)) or
+                                         shape([random.random() for _ in range(math.prod(x))]
+                                               if y is None
+                                               else [random.uniform(0, y) for _ in range(math.prod(x))], x),
+                       (1, 0, 1), (1, 0, 1), pure=False),
+             '!': rank(lambda x, y=None: allocate(x) or math.factorial(x)
+                                         if y is None
+                                         else combinations(x, y),
+                       0),
+             '#': rank(lambda x, y=None: (allocate(sum(y) if len(y) > 1 else len(x) * sum(y)) or
+                                          ([z for i, z in zip(y, x) for _ in range(i)]
+                                           if len(y) > 1
+                                           else [z for z in x for _ in range(y)]))
+                                         if y is not None
+                                         else [i for i, z in enumerate(x) if z],
+                       (MAXRANK, 1, MAXRANK), (1, 1, 1), seq=True),
+             'A': rank(lambda x, y=None: x, MAXRANK, seq=True),
+             'B': rank(lambda x, y=None: y if y is not None else x, MAXRANK, seq=True),
              'Ba': rank(lambda x, y=[2]: int2base(x, y),
                         (0, 1, 0), (0, 1, 0)), 
              'Bn': rank(lambda x, y=[2]: base2int(x, y),
                         (1, 1, 1), (1, 1, 1)), 
-             'C': rank(lambda x, y=1: sum(1 for z in x if z == y),
-                       (MAXRANK, -1, MAXRANK), (1, 0, 1)), 
-             'Ch': rank(lambda x, y=None: chr(x),
-                        (0, MAXRANK, 0)), 
-             'Co': rank(lambda x, y=None: ord(x),
-                        (0, MAXRANK, 0)), 
-             'D': lambda x, y=None: +depth(x),
-             'E': rank(lambda x, y=None: (x[-1] if y is None else x[-y:]) if x else x, (MAXRANK, 0, MAXRANK), (1, 0, 1)),
+             'C': rank(lambda x, y=1: count(x, y), MAXRANK, (1, 0, 1), seq=True),
+             'Ch': rank(lambda x, y=None: chr(x) if not isinstance(x, list) else
+                                         Text(''.join(map(chr, x))) if all(type(z) is int for z in x) else
+                                         shaped([call(primitives['Ch'], z) for z in x]),
+                        (1, MAXRANK, 0)), 
+             'Co': rank(lambda x, y=None: ord(x) if type(x) is str else
+                                         list(map(ord, x)) if textual(x) else
+                                         shaped([call(primitives['Co'], z) for z in x]),
+                        (1, MAXRANK, 0), seq=True), 
+             'D': rank(lambda x, y=None: +depth(x), MAXRANK),
+             'E': rank(lambda x, y=None: (x[-1] if y is None else cut(x, slice(-y, None))) if x else x, (MAXRANK, 0, MAXRANK), (1, 0, 1), seq=True),
              'F': rank(lambda x, y=None: float(x), (1, MAXRANK, 1)),
-             'H': rank(lambda x, y=None: x[0] if y is None else x[:y], (MAXRANK, 0, MAXRANK), (1, 0, 1)),
+             'Gu': rank(lambda x, y=None: grade(x), MAXRANK, (1, 0, 1), seq=True),
+             'Gd': rank(lambda x, y=None: grade(x, True), MAXRANK, (1, 0, 1), seq=True),
+             'H': rank(lambda x, y=None: x[0] if y is None else cut(x, slice(y)), (MAXRANK, 0, MAXRANK), (1, 0, 1), seq=True),
              'I': rank(lambda x, y=10: int(''.join(x), y) if isinstance(x, list) else int(x), (0, 0, 1)),
              'Ir': rank(lambda x, y=None: int(x) if x - int(x) < 0.5 else int(x+0.5),
                         (0, MAXRANK, 0)), 
-             'J': rank(lambda x, y=['']: join(x, y), (MAXRANK, 1, MAXRANK), (2, 1, 2)), 
-             'Ld': rank(lambda x, y=1: x[y:] if len(x) else x, (MAXRANK, 0, MAXRANK), (1, 0, 1)),
-             'Lr': rank(lambda x, y=1: x[:-y] if len(x) else x, (MAXRANK, 0, MAXRANK), (1, 0, 1)),
+             'J': rank(lambda x, y=['']: join(x, y), (MAXRANK, 1, MAXRANK), (2, 1, 2), seq=True), 
+             'Ld': rank(lambda x, y=1: cut(x, slice(y, None)) if len(x) else x, (MAXRANK, 0, MAXRANK), (1, 0, 1), seq=True),
+             'Lr': rank(lambda x, y=1: cut(x, slice(-y)) if len(x) else x, (MAXRANK, 0, MAXRANK), (1, 0, 1), seq=True),
              'Lt': rank(lambda x, y=None: [[x]], (MAXRANK, MAXRANK, MAXRANK)),
              'N': rank(lambda x, y=None: len(x) if y is None else
                                          x[y] if isinstance(y, int) else x[int(len(x)*y)],
-                       (MAXRANK, 0, MAXRANK), (1, 0, 1)),
-             'O': rank(lambda x, y=None: [x[i] for i,_ in sorted(enumerate(y), key=lambda x:x[1])]
-                                         if y is not None
-                                         else sorted(x),
-                       (MAXRANK, MAXRANK, MAXRANK), (1, 1, 1)), 
+                       (MAXRANK, 0, MAXRANK), (1, 0, 1), seq=True),
+             'O': rank(lambda x, y=None: gather(x, grade(y)) if y is not None else sort(x),
+                       (MAXRANK, MAXRANK, MAXRANK), (1, 1, 1), seq=True),
+             'Oh': rank(lambda x, y=None: sortby(x, x if y is None else y, 0),
+                        (MAXRANK, MAXRANK, MAXRANK), (1, 1, 1), seq=True),
+             'Oe': rank(lambda x, y=None: sortby(x, x if y is None else y, -1),
+                        (MAXRANK, MAXRANK, MAXRANK), (1, 1, 1), seq=True),
              'P': rank(lambda x, y=0: list(map(list, itertools.zip_longest(*x, fillvalue=y))),
                        (MAXRANK, MAXRANK, MAXRANK), (2, 0, 2)), 
-             'Pr': rank(lambda x, y=None: (print(''.join(y).format(*map(str, x))) if y is not None else print(x)) or 0,
-                       (MAXRANK, 1, MAXRANK), (1, 1, 1)), 
+             'Pr': rank(lambda x, y=None: (print(''.join(y).format(*map(str, tolist(x)))) if y is not None else print(tolist(x))) or 0,
+                        (MAXRANK, 1, MAXRANK), (1, 1, 1), pure=False),
              'Ps': rank(lambda x, y=None: padarray(x)
                                           if y is None
-                                          else [0]*(y-len(x))+x,
+                                          else allocate(max(y, len(x))) or [0]*(y-len(x))+x,
                         (MAXRANK, 0, MAXRANK), (2, 0, 1)), 
              'Pe': rank(lambda x, y=None: padarray(x, 1)
                                           if y is None
-                                          else x+[0]*(y-len(x)),
+                                          else allocate(max(y, len(x))) or x+[0]*(y-len(x)),
                         (MAXRANK, 0, MAXRANK), (2, 0, 1)), 
-             'R': rank(lambda x, y=None: list(range(int(y), int(x)+(x>y or -1), x>y or -1)) \
+             'R': rank(lambda x, y=None: iota(range(int(y), int(x)+(x>y or -1), x>y or -1)) \
                                          if y is not None \
-                                         else list(range(0, x, x>0 or -1)),
+                                         else iota(range(0, x, x>0 or -1)),
                        (0, 0, 0)),
-             'S': rank(lambda x, y=None: list(str(x)) if y is None else split(x, y), (MAXRANK, MAXRANK, MAXRANK), (0, 1, 1)),
-             'Sf': rank(lambda x, y=None: list(''.join(y).format(*x)),
-                        (MAXRANK, 1, MAXRANK), (1, 1, 1)),
-             'T': rank(lambda x, y=None: (table(list(range(functools.reduce(lambda x, y: x*y, x))), x)
+             'S': rank(lambda x, y=None: Text(str(tolist(x))) if y is None else split(x, y),
+                       (MAXRANK, MAXRANK, MAXRANK), (0, 1, 1), seq=True),
+             'Sf': rank(lambda x, y=None: Text(''.join(y).format(*tolist(x))),
+                        (MAXRANK, 1, MAXRANK), (1, 1, 1), seq=True),
+             'T': rank(lambda x, y=None: (table(range(math.prod(x)), x)
                                           if x != [0] else [])
                                          if y is None
                                          else table(x, y),
                        (1, 1, 1), (1, 1, 1)),
-             'V': rank(lambda x, y=None: x[::-1],
-                       (MAXRANK, MAXRANK, MAXRANK), (1, 0, 1))
+             'V': rank(lambda x, y=None: cut(x, slice(None, None, -1)),
+                       (MAXRANK, MAXRANK, MAXRANK), (1, 0, 1), seq=True)
              }
-functions['+'].rank = (0, 0, 0)
-functions['+l'].rank = (MAXRANK, MAXRANK, MAXRANK)
-functions['+b'].rank = (0, 0, 0)
-functions['+l'].pad = (0, 1, 0)
-functions['-'].rank = (0, 0, 0)
-functions['*'].rank = (0, 0, 0)
-functions['*p'].rank = (0, 0, 0)
-functions['*b'].rank = (0, 0, 0)
-functions['%'].rank = (0, 0, 0)
-functions[';'].rank = (MAXRANK, MAXRANK, MAXRANK)
-functions[';'].pad = (2, 1, 1)
-functions[';p'].rank = (MAXRANK, MAXRANK, MAXRANK)
-functions[';p'].pad = (1, 0, 0)
-functions['|'].rank = (0, 0, 0)
-functions['<'].rank = (0, 0, 0)
-functions['>'].rank = (0, 0, 0)
-functions['<e'].rank = (0, 0, 0)
-functions['>e'].rank = (0, 0, 0)
-functions['<c'].rank = (0, 0, 0)
-functions['>c'].rank = (0, 0, 0)
-functions['='].rank = (0, 0, 0)
-functions['=,'].rank = (MAXRANK, MAXRANK, MAXRANK)
-functions['=,'].rank = (1, 1, 1)
-functions['=:'].rank = (MAXRANK, MAXRANK, MAXRANK)
-functions[']'].rank = (MAXRANK, 0, MAXRANK)
-functions['-l'].rank = (MAXRANK, MAXRANK, MAXRANK)
-functions['-l'].pad = (1, 1, 1)
-functions['-u'].rank = (MAXRANK, MAXRANK, MAXRANK)
-functions['-u'].pad = (1, 1, 1)
-functions['?'].rank = (1, 0, 1)
-functions['?'].pad = (1, 0, 1)
-functions['!'].rank = (0, 0, 0)
-functions['#'].rank = (MAXRANK, 1, MAXRANK)
-functions['#'].pad = (1, 1, 1)
-
-synonyms = {'Oh': 'O$,MH',
-            'Oe': 'O$,ME',
+for n, f in primitives.items():
+    f.name = n
+primitives = types.MappingProxyType(primitives)
+
+# NumPy versions of rank 0 primitives: (monad, dyad, overflow check).
+# Like the primitives, the dyads take the right argument first.
+vectorized = {primitives['+']: (lambda x: x, lambda x, y: y + x, '+'),
+              primitives['-']: (lambda x: -x, lambda x, y: x - y, '+'),
+              primitives['*']: (lambda x: (x > 0).astype(int) - (x < 0).astype(int),
+                               lambda x, y: x * y, '*'),
+              primitives['%']: (lambda x: 1 / x, lambda x, y: y / x, None),
+              primitives['|']: (abs, lambda x, y: x % y, None),
+              primitives['<']: (lambda x: x > 0, lambda x, y: x > y, None),
+              primitives['>']: (lambda x: x < 0, lambda x, y: x < y, None),
+              primitives['<e']: (lambda x: x >= 0, lambda x, y: x >= y, None),
+              primitives['>e']: (lambda x: x <= 0, lambda x, y: x <= y, None),
+              primitives['<c']: (lambda x: x, lambda x, y: numpy.minimum(x, y), None),
+              primitives['>c']: (lambda x: x, lambda x, y: numpy.maximum(x, y), None),
+              primitives['=']: (lambda x: (x == 0).astype(int), lambda x, y: (x == y).astype(int), None),
+              } if numpy else {}
+
+def numbers(r):
+    """Run a builtin reduction only on flat lists of numbers, where it gives
+       the same result as folding the primitive."""
+    def F(xs):
+        if type(xs) is range or set(map(type, xs)) <= {int, float, bool}:
+            return r(xs)
+    return F
+
+def scalar(a):
+    """Unwrap a 0 dimensional array."""
+    return a if a.ndim else a.item()
+
+def sumarray(a):
+    if a.dtype.kind == 'b' or a.dtype.kind in 'iu' and magnitude(a) * len(a) < 2**62:
+        return scalar(a.sum(0))
+
+# Reductions of associative primitives: (list version, NumPy version over
+# the first axis).
+# Folding goes from the right, so sums and products run over the reversed
+# list to add in the same order, and <c, >c keep the leftmost extreme.
+reducers = {primitives['+']: (numbers(lambda xs: (xs[0] + xs[-1]) * len(xs) // 2
+                                              if type(xs) is range
+                                              else sum(reversed(xs))), sumarray),
+            primitives['*']: (numbers(lambda xs: math.prod(reversed(xs))), None),
+            primitives['<c']: (numbers(lambda xs: min(xs[0], xs[-1]) if type(xs) is range else min(xs)),
+                              lambda a: scalar(a.min(0))),
+            primitives['>c']: (numbers(lambda xs: max(xs[0], xs[-1]) if type(xs) is range else max(xs)),
+                              lambda a: scalar(a.max(0))),
+            primitives['+b']: (numbers(lambda xs: +next((z for z in reversed(xs) if z), xs[0])), None),
+            primitives['*b']: (numbers(lambda xs: +next((z for z in reversed(xs) if not z), xs[0])), None),
+            primitives[';']: (lambda xs: [z for y in xs for z in y]
+                                        if all(type(y) in (list, Array, range, View, Text) for y in xs)
+                                        else None, None),
             }
 
-variables = {'Z': []
+def sumscan(a):
+    if a.dtype.kind == 'f' or a.dtype.kind in 'iu' and magnitude(a) * len(a) < 2**62:
+        return numpy.cumsum(a)
+
+def subtract(r, k, left):
+    """Range version of -, which takes the left argument from the right one."""
+    return range(k - r.start, k - r.stop, -r.step) if left else range(r.start - k, r.stop - k, r.step)
+
+# Rank 0 primitives applied to a range and an integer, giving a range
+# without expanding it. Unlike the primitives, these take the left argument
+# first. They return None for anything else.
+ranged = {primitives['+']: lambda x, y: (range(x.start + y, x.stop + y, x.step) if type(y) is int
+                                        else range(y.start + x, y.stop + x, y.step) if type(x) is int
+                                        else None),
+          primitives['-']: lambda x, y: (range(-x.start, -x.stop, -x.step) if y is None
+                                        else subtract(x, y, True) if type(y) is int
+                                        else subtract(y, x, False) if type(x) is int
+                                        else None),
+          primitives['*']: lambda x, y: (range(x.start * y, x.stop * y, x.step * y) if type(y) is int and y
+                                        else range(y.start * x, y.stop * x, y.step * x) if type(x) is int and x
+                                        else None),
+          }
+
+# Running versions of the NumPy reductions, for scans over arrays.
+accumulators = {primitives['+']: sumscan,
+                primitives['<c']: numpy.minimum.accumulate,
+                primitives['>c']: numpy.maximum.accumulate,
+                } if numpy else {}
+
+# The variables every interpreter starts with.
+defaults = {'Z': []
             }
 
+def array(v):
+    """Convert a value to something NumPy can operate on, or return None if
+       it isn't homogeneous numeric data."""
+    if isinstance(v, numpy.ndarray):
+        return v if v.dtype.kind in 'iuf' else None
+    t = type(v)
+    if t is float or t is int and -2**62 < v < 2**62:
+        return v
+    if t is range and v and -2**62 < min(v[0], v[-1]) and max(v[0], v[-1]) < 2**62:
+        allocate(len(v))
+        return numpy.arange(v.start, v.stop, v.step)
+    if t is View:
+        v = v.tolist()
+    if isinstance(v, list) and v:
+        t = set(map(type, v))
+        if t == {float}:
+            return numpy.array(v, dtype=numpy.float64)
+        if t == {int}:
+            try:
+                return numpy.array(v, dtype=numpy.int64)
+            except OverflowError:
+                pass
+    return None
+
+def magnitude(v):
+    """Largest absolute value of an integer array, or 0 for floats."""
+    if isinstance(v, numpy.ndarray):
+        return int(numpy.abs(v).max()) if v.dtype.kind in 'iu' and v.size else 0
+    return abs(v) if type(v) is int else 0
+
+def vectorize(f, x, y=None):
+    """Apply a rank 0 primitive to numeric arrays as a single NumPy operation.
+       Returns None if the arguments can't be handled that way."""
+    x = array(x)
+    if x is None:
+        return None
+    monad, dyad, grows = vectorized[f]
+    if y is None:
+        if grows and magnitude(x) >= 2**62:
+            return None
+        with numpy.errstate(divide='raise', invalid='raise'):
+            r = monad(x)
+        allocate(numpy.size(r))
+        return r
+    y = array(y)
+    if y is None or numpy.shape(x) != numpy.shape(y) and numpy.ndim(x) and numpy.ndim(y):
+        return None
+    if grows == '+' and magnitude(x) + magnitude(y) >= 2**62 \
+       or grows == '*' and magnitude(x) * magnitude(y) >= 2**62:
+        return None
+    with numpy.errstate(divide='raise', invalid='raise'):
+        r = dyad(y, x)
+    allocate(numpy.size(r))
+    return r
+
+def big(v):
+    return isinstance(v, numpy.ndarray) or isinstance(v, (list,) + lazytypes) and len(v) >= ARRAYS
+
+def tolist(v):
+    """Convert arrays, ranges, views and texts in a value back to plain lists."""
+    if isinstance(v, arraytypes):
+        allocate(v.size)
+        return v.tolist()
+    if type(v) is range or type(v) is Text:
+        allocate(len(v))
+        return list(v)
+    if type(v) is View:
+        v = v.tolist()
+    if isinstance(v, list):
+        for i, z in enumerate(v):
+            if isinstance(z, (list,) + lazytypes + arraytypes):
+                w = tolist(z)
+                if w is not z:
+                    v = v[:i] + [w] + [tolist(z) for z in v[i+1:]]
+                    break
+    return v
+
+def iota(r):
+    """Long ranges are kept lazy, see 'ranged'. Short ones are made lists."""
+    return r if len(r) >= ARRAYS else shaped(r)
+
+atoms = {int, float, bool, str}
+flattypes = atoms | {Text} # Items of lists needing no conversion to compare them
+
+# Specialized loops for rank 0 functions over flat lists. Items which turn
+# out to be lists go through call() as usual. They return None if they
+# don't apply.
+def mapflat(f, x, y):
+    m = f.monad
+    return shaped([m(z) if type(z) in atoms else call(f, z) for z in x])
+
+def mapleft(f, x, y):
+    d = f.dyad
+    return shaped([d(y, z) if type(z) in atoms else call(f, z, y) for z in x])
+
+def mapright(f, x, y):
+    d = f.dyad
+    return shaped([d(z, x) if type(z) in atoms else call(f, x, z) for z in y])
+
+def zipflat(f, x, y):
+    if len(x) == len(y):
+        d = f.dyad
+        return shaped([d(b, a) if type(a) in atoms and type(b) in atoms else call(f, a, b)
+                       for a, b in zip(x, y)])
+
+lifts = {(1, None): mapflat, (1, 0): mapleft, (0, 1): mapright, (1, 1): zipflat}
+
+def lifting(f, dx, dy):
+    """Select the loop for applying a rank 0 function to arguments of the
+       given depths. The choice is cached on the function."""
+    try:
+        return f.lifts[dx, dy]
+    except KeyError:
+        f.lifts[dx, dy] = lifts.get((dx, dy)) if f.pad == (0, 0, 0) else None
+        return f.lifts[dx, dy]
+
+pool = None
+
+def parallel(f, items, xdepth, ydepth):
+    """Call f on (left, right) pairs in a pool of PROCESSES worker processes.
+       The items are cut to chunks, and the results come back in order.
+       Returns None if f has side effects or can't be sent to the workers,
+       or if the evaluation has a governor (which the workers couldn't
+       count against), in which case the caller calls f itself."""
+    global pool
+    if not f.pure or f in scalars or current.get().governor is not None:
+        return None
+    n = -(-len(items) // (PROCESSES * 4))
+    try:
+        # Send the functions defined by the user along, since f may call them by name.
+        user = {k: g for k, g in current.get().functions.items() if primitives.get(k) is not g}
+        head = pickle.dumps((user, f, xdepth, ydepth))
+        chunks = [(head, pickle.dumps(items[i:i+n])) for i in range(0, len(items), n)]
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+    if pool is None:
+        pool = multiprocessing.Pool(PROCESSES, serial)
+        atexit.register(pool.terminate)
+    try:
+        return shaped(list(itertools.chain.from_iterable(pool.map(work, chunks, 1))))
+    except multiprocessing.pool.MaybeEncodingError:
+        return None
+
+def serial():
+    """Keep the workers from starting pools of their own."""
+    global PROCESSES
+    PROCESSES = 0
+
+def work(chunk):
+    """Run a chunk of parallel() in a worker, in an interpreter of its own."""
+    head, items = chunk
+    token = current.set(Interpreter())
+    try:
+        user, f, xdepth, ydepth = pickle.loads(head)
+        current.get().functions.update(user)
+        return [call(f, x, y, xdepth, ydepth) for x, y in pickle.loads(items)]
+    finally:
+        current.reset(token)
+
 def call(f, x, y=None, xdepth=0, ydepth=0):
     x, y, f = resolve(x), resolve(y), resolve(f)
     debugprint("Call:", (f, x, y))
+    if governing:
+        governor = current.get().governor
+        if governor is not None:
+            governor.step()
 #    print(f) # In case of "str is not callable"
-    rank, lrank, rrank = rankof(f)
+    if not isinstance(f, Function):
+        f = Function(f)
+    lazy = type(x) in lazytypes or type(y) in lazytypes
+    if lazy and f in ranged and (type(x) is range or type(y) is range):
+        r = ranged[f](x, y)
+        if r is not None:
+            return r
+    if numpy:
+        if f in vectorized and (big(x) or big(y)):
+            r = vectorize(f, x, y)
+            if r is not None:
+                return r
+        if not f.arrays:
+            if isinstance(x, numpy.ndarray):
+                allocate(x.size)
+                x = x.tolist()
+            if isinstance(y, numpy.ndarray):
+                allocate(y.size)
+                y = y.tolist()
+    if lazy and not f.seq:
+        if type(x) is range or type(x) is Text:
+            x = shaped(x)
+        elif type(x) is View:
+            x = x.tolist()
+        if type(y) is range or type(y) is Text:
+            y = shaped(y)
+        elif type(y) is View:
+            y = y.tolist()
+    rank, lrank, rrank = f.rank
     if y is None:
         dx = depth(x)
+        if not rank and dx:
+            lift = lifting(f, dx, None)
+            if lift:
+                return lift(f, x, y)
         if 0 > rank < xdepth or dx > rank >= 0:
-            return [call(f, z, None, xdepth-1) for z in x]
-#        if not hasattr(f, '__call__'):
-#            return f
-        pad = padrank(f)[0]
+            if PROCESSES and isinstance(x, (list,) + lazytypes) and len(x) >= PARALLEL:
+                r = parallel(f, [(z, None) for z in x], xdepth-1, 0)
+                if r is not None:
+                    return r
+            return shaped([call(f, z, None, xdepth-1) for z in x])
+        pad = f.pad[0]
         if dx < pad:
             for _ in range(pad - dx):
                 x = [x]
-        return f(x)
+        return f.monad(x)
     dx, dy = depth(x), depth(y)
-    xr = isinstance(x, list) and (0 > lrank < xdepth or dx > lrank >= 0)
-    yr = isinstance(y, list) and (0 > rrank < ydepth or dy > rrank >= 0)
+    if not (lrank or rrank) and (dx or dy):
+        lift = lifting(f, dx, dy)
+        if lift:
+            r = lift(f, x, y)
+            if r is not None:
+                return r
+    xr = isinstance(x, (list,) + lazytypes) and (0 > lrank < xdepth or dx > lrank >= 0)
+    yr = isinstance(y, (list,) + lazytypes) and (0 > rrank < ydepth or dy > rrank >= 0)
+    if PROCESSES and (xr or yr) and max(len(x) if xr else 0, len(y) if yr else 0) >= PARALLEL:
+        if xr and yr and len(x) == len(y):
+            r = parallel(f, list(zip(x, y)), xdepth-1, ydepth-1)
+        elif xr:
+            r = parallel(f, [(z, y) for z in x], xdepth-1, ydepth)
+        else:
+            r = parallel(f, [(x, z) for z in y], xdepth, ydepth-1)
+        if r is not None:
+            return r
     if xr and yr and len(x) == len(y):
-        return [call(f, a, b, xdepth-1, ydepth-1) for a, b in zip(x, y)]
+        return shaped([call(f, a, b, xdepth-1, ydepth-1) for a, b in zip(x, y)])
     if xr:
-        return [call(f, z, y, xdepth-1, ydepth) for z in x]
+        return shaped([call(f, z, y, xdepth-1, ydepth) for z in x])
     elif yr:
-        return [call(f, x, z, xdepth, ydepth-1) for z in y]
-    pad = padrank(f)
+        return shaped([call(f, x, z, xdepth, ydepth-1) for z in y])
+    pad = f.pad
     if dx < pad[1]:
         for _ in range(pad[1] - dx):
             x = [x]
     if dy < pad[2]:
         for _ in range(pad[2] - dy):
             y = [y]
-#    if not hasattr(f, '__call__'):
-#        return f
-    return f(y, x)
+    return f.dyad(y, x)
+
+# Functions with rank 0 that always return a scalar.
+scalars = {primitives[n] for n in ('+', '-', '*', '*p', '*b', '+b', '%', '|', '!',
+                                  '<', '>', '<e', '>e', '<c', '>c', '=')}
+
+# Train instructions. L is the left argument of the train (if any),
+# T is the top of the stack.
+MONAD = 0 # T = F T
+DYAD  = 1 # T = L F T
+BOUND = 2 # T = V F T
+DUP   = 3 # push T
+SWAP  = 4 # swap T and the item below it
+FORK  = 5 # pop T, T = T F (popped T)
+FUSED = 6 # T = F T, or the steps V (fused to F) one by one if T is long
+
+class Train(Function):
+    """A tacit train lowered to flat instruction sequences, which are run by
+       a single loop instead of a tower of nested closures."""
+    __slots__ = ('node', 'monadcode', 'dyadcode')
+
+    def __init__(self, node):
+        Function.__init__(self, self.run, seq=True)
+        self.node = node
+        self.monadcode = fuse(lower(node, MONAD))
+        self.dyadcode = fuse(lower(node, DYAD))
+
+    def run(self, x, y=None):
+        stack = [x]
+        for op, f, v in (self.monadcode if y is None else self.dyadcode):
+            if op == MONAD:
+                stack[-1] = call(f, stack[-1])
+            elif op == DYAD:
+                stack[-1] = call(f, y, stack[-1])
+            elif op == BOUND:
+                stack[-1] = call(f, v, stack[-1])
+            elif op == DUP:
+                stack.append(stack[-1])
+            elif op == SWAP:
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            elif op == FUSED:
+                x = stack[-1]
+                if isinstance(x, arraytypes) or isinstance(x, (list,) + lazytypes) and len(x) >= ARRAYS:
+                    # Long arguments are faster with the NumPy and range versions of each step.
+                    for op, f, v in v:
+                        x = call(f, x) if op == MONAD else call(f, v, x)
+                    stack[-1] = x
+                else:
+                    stack[-1] = call(f, x)
+            else:
+                r = stack.pop()
+                stack[-1] = call(f, stack[-1], r)
+        return stack[-1]
+
+def lower(node, mode):
+    """Lower a train node to instructions. Mode is MONAD or DYAD."""
+    if isinstance(node, Train):
+        node = node.node
+    if not isinstance(node, tuple):
+        return [(mode, node, None)]
+    if node[0] == 'combine':
+        return lower(node[2], mode) + lower(node[1], mode)
+    if node[0] == 'fork':
+        return ([(DUP, None, None)] + lower(node[1], mode) + [(SWAP, None, None)]
+                + lower(node[3], mode) + [(FORK, node[2], None)])
+    return [(BOUND, node[1], node[2])]
+
+def fuse(code):
+    """Fuse adjacent scalar steps of a train to a single elementwise function,
+       so the argument is traversed once. The steps are kept for arguments
+       which the steps can handle whole."""
+    r = []
+    run = []
+    for i in code + [(None, None, None)]:
+        op, f, v = i
+        if f in scalars and (op == MONAD or op == BOUND and type(v) in atoms):
+            run.append(i)
+            continue
+        if len(run) > 1:
+            steps = [f if op == MONAD else functools.partial(lambda f, v, x: f(x, v), f, v)
+                     for op, f, v in run]
+            r.append((FUSED, rank(lambda x, y=None, steps=steps: functools.reduce(lambda x, f: f(x), steps, x), 0), run))
+        else:
+            r += run
+        run = []
+        if op is not None:
+            r.append(i)
+    return r
+
+def train(kind, *args):
+    """Build a train ('combine', 'fork' or 'bind') with the selected engine."""
+    if TRAINS == 'vm':
+        return recipe(Train((kind,) + args), 'train', kind, *args)
+    return recipe({'combine': combine, 'fork': fork, 'bind': bind}[kind](*args), 'train', kind, *args)
 
 def withAdverb(a, f):
-    return adverbs[a](f)
+    return recipe(adverbs[a](f), 'adverb', a, f)
 
 def withConjunction(c, f, x):
-    return conjunctions[c](f, x)
+    return recipe(conjunctions[c](f, x), 'conjunction', c, f, x)
+
+def recipe(f, *how):
+    """Record how a function was built, see build()."""
+    if isinstance(f, Function) and f.recipe is None and primitives.get(f.name) is not f:
+        f.recipe = how
+    return f
 
-nameEndAlphabet = 'abcdefghijklmnopqrstuvwyxz'
+def build(kind, *args):
+    """Rebuild a function from its recipe."""
+    if kind == 'primitive':
+        return primitives[args[0]]
+    if kind == 'memo':
+        return usermemoize(*args)
+    return {'train': train, 'adverb': withAdverb, 'conjunction': withConjunction}[kind](*args)
+
+nameEndAlphabet = 'abcdefghijklmnopqrstuvwyxz,'
 nameStartAlphabet = 'ABCDEFGHIJKLMNOPQRSTUVWYXZ^!#%=?+*<>;|]-`/$@`~\\'
 startAlphabet = nameStartAlphabet
+digits = '1234567890.'
 typeSynonyms = {'value': ('list', 'variable'),
                 'name': ('function', 'variable')}
 
+def tokenize(code):
+    """Split the code into tokens in a single right-to-left pass.
+       Returns a list of (position, token) pairs in source order."""
+    tokens = []
+    i = len(code)
+    while i:
+        c = code[i-1]
+        if i > 1 and code[i-2] == "'":
+            i -= 2
+            tokens.append((i, ('single', c)))
+            continue
+        j = i - 1
+        if c == '"':
+            while True:
+                j -= 1
+                if j < 0:
+                    raise SyntaxError("Unterminated string ending at %d" % (i-1))
+                if code[j] == '"':
+                    k = j
+                    while k and code[k-1] == '\\':
+                        k -= 1
+                    if not (j - k) % 2:
+                        break
+            t = ('string', unescape(code[j+1:i-1].encode()).decode())
+        elif c in digits:
+            dot = c == '.'
+            while j and code[j-1] in digits:
+                if code[j-1] == '.':
+                    if dot:
+                        break
+                    dot = True
+                j -= 1
+            s = code[j:i]
+            if j and code[j-1] == '_':
+                j -= 1
+                s = '-' + s
+            t = ('number', float(s) if '.' in s else int(s))
+        elif c in ' ({[)':
+            t = c
+        elif c == ':':
+            t = ('assign', c)
+        elif c in startAlphabet:
+            t = ('name', c)
+        elif c in nameEndAlphabet:
+            while code[j-1] not in startAlphabet:
+                j -= 1
+                if not j:
+                    raise SyntaxError("Name without a start at %d" % (i-1))
+            j -= 1
+            t = ('name', code[j:i])
+        else:
+            raise SyntaxError("Unexpected character %r at %d" % (c, j))
+        tokens.append((j, t))
+        i = j
+    tokens.reverse()
+    return tokens
+
+def matchBraces(tokens):
+    """Map the index of every closing brace to the type of its opening brace."""
+    braces = {}
+    closing = []
+    for i in reversed(range(len(tokens))):
+        t = tokens[i][1]
+        if t == ')':
+            closing.append(i)
+        elif t in ('(', '{', '[') and closing:
+            braces[closing.pop()] = t
+    return braces
+
+class Slot:
+    """Refers to the result of an instruction of a compiled program."""
+    __slots__ = ('index',)
+    def __init__(self, index):
+        self.index = index
+
+def resolving(f):
+    """Wrap f to resolve all of its arguments before calling it."""
+    return lambda *args: f(*map(resolve, args))
+
+def pure(x):
+    """Tell if a function (or list of them) has no side effects. Variables
+       don't count as pure, since they can be reassigned."""
+    if isinstance(x, tuple):
+        if x[0] == 'variable':
+            return False
+        if x[0] != 'function':
+            return True
+        x = current.get().functions.get(x[1]) if isinstance(x[1], str) else x[1]
+    if isinstance(x, Function):
+        return x.pure
+    if isinstance(x, list):
+        return all(map(pure, x))
+    return x is not None
+
+def building(f):
+    """Wrap a function builder to mark the functions it builds impure if
+       any of the arguments is."""
+    def F(*args):
+        r = f(*args)
+        if isinstance(r, Function) and not all(map(pure, args)):
+            r.pure = False
+        return r
+    return F
+
+def usermemoize(n, f):
+    """Memoize a pure user-defined function in the running interpreter."""
+    if not isinstance(f, Function) or not f.pure:
+        return f
+    c = current.get().caches[n] = Cache(n, CACHESIZE, True)
+    current.get().memoized.add(n)
+    # Keep the flags of f, so folds and scans of it still take their fast paths.
+    return recipe(rank(c.wrap(f, lambda: c), f.rank, f.pad, assoc=f.assoc, seq=f.seq,
+                       arrays=f.arrays, over=f.over, grows=f.grows, name=n),
+                  'memo', n, f)
+
+def setfunction(n, f):
+    interpreter = current.get()
+    if n in interpreter.functions and interpreter.memoized:
+        # Memoized functions may call the old definition by name.
+        for m in interpreter.memoized:
+            interpreter.caches[m].clear()
+            if not pure(f):
+                interpreter.caches[m].resize(0)
+    f = resolve(f)
+    interpreter.functions[n] = usermemoize(n, f) if MEMOIZE else f
+
+def setvariable(n, v):
+    current.get().variables[n] = resolve(v)
+
+def fresh(v):
+    """A copy of a list and the lists in it."""
+    if not isinstance(v, list):
+        return v
+    l = list(map(fresh, v))
+    return shaped(l) if type(v) is Array else l
+
+class Program:
+    """A compiled line of code. Running it executes the recorded instructions
+       in the order the parser reduced them. Kinds are the kinds the names in
+       the code had when it was compiled."""
+    def __init__(self, code, instructions, result, kinds):
+        self.code = code
+        self.instructions = instructions
+        self.result = result
+        self.kinds = kinds
+
+    def run(self, bindings=None):
+        """Run the program, optionally binding variables first. Returns the
+           resulting stack item. The literal lists of the program are copied
+           for each run, since programs are cached and reused."""
+        if bindings:
+            current.get().variables.update(bindings)
+        values = []
+        fetch = lambda x: ((x[0], values[x[1].index])
+                           if type(x) is tuple and type(x[1]) is Slot
+                           else (x[0], fresh(x[1]))
+                           if type(x) is tuple and isinstance(x[1], list)
+                           else x)
+        for op, args in self.instructions:
+            values.append(op(*map(fetch, args)))
+        return fetch(self.result)
+
 class Interpreter:
+    """Compiles and runs Joe code in a namespace of its own: the functions
+       (which start as a copy of the primitives), variables and memo caches
+       of one interpreter are never seen by another. Several interpreters
+       can run at once in separate threads, but each of them in one thread
+       at a time. While a line runs, current holds its interpreter."""
     def __init__(self):
+        self.functions = dict(primitives)
+        self.variables = dict(defaults)
+        self.caches = {n: c.copy() for n, c in caches.items()}
+        self.memoized = set()
+        self.governor = None
         self.stack = []
         self.overhead = (None, None)
-        self.code = ""
-
-    def peekName(self):
-        c = self.code[-1]
-        if c in startAlphabet:
-            return c
-        if c in nameEndAlphabet:
-            count = 1
-            while self.code[-count-1] not in startAlphabet:
-                count += 1
-                c += self.code[-count]
-            c += self.code[-count-1]
-            return c[::-1]
-        return False
+        self.tokens = []
+        self.braces = {}
+        self.pos = 0
+        self.names = {}
+        self.instructions = []
 
-    def readName(self):
-        n = self.peekName()
-        if n is not False:
-            self.code = self.code[:-len(n)]
-        return n
-
-    def peekLiteral(self):
-        c = self.code[-1]
-        if len(self.code) > 1 and self.code[-2] == "'":
-            return ('single', c)
-        elif c == '"':
-            count = 2
-            s = ""
-            while True:
-                c = self.code[-count]
-                if c == '"':
-                    i = 1
-                    t = False
-                    while len(self.code) > count + i and self.code[-count-i] == '\\':
-                        t = not t
-                        i += 1
-                    if not t:
-                        break
-                s += c
-                count += 1
-            return ('string', unescape(s[::-1].encode()).decode())
-        elif c in '1234567890.':
-            count = 2
-            s = c
-            while len(self.code) >= count and self.code[-count] in '1234567890.':
-                if self.code[-count] == '.' and '.' in s:
-                    break
-                s += self.code[-count]
-                count += 1
-            s = s[::-1]
-            if len(self.code) >= count and self.code[-count] == '_':
-                s = '-' + s
-            return ('number', float(s) if '.' in s else int(s), len(s))
-        return False
+    def classify(self, t):
+        """Resolve the syntactic type of a name token."""
+        if isinstance(t, tuple) and t[0] == 'name':
+            c = t[1]
+            if c in self.functions or self.names.get(c) == 'function':
+                return ('function', c)
+            elif c in conjunctions:
+                return ('conjunction', c)
+            elif c in adverbs:
+                return ('adverb', c)
+            elif c in self.variables or self.names.get(c) == 'variable':
+                return ('variable', c)
+        return t
 
     def peek(self):
-        if len(self.code):
-            c = self.peekLiteral()
-            if c:
-                return c
-            c = self.code[-1]
-            if c in ' ({[)':
-                return c
-            elif c == ':':
-                return ('assign', c)
-            c = self.peekName()
-            if c:
-                if c in functions:
-                    return ('function', c)
-                elif c in conjunctions:
-                    return ('conjunction', c)
-                elif c in adverbs:
-                    return ('adverb', c)
-                elif c in variables:
-                    return ('variable', c)
-                return ('name', c)
+        if self.pos:
+            return self.classify(self.tokens[self.pos-1][1])
         return False
 
     def read(self):
         x = self.peek()
         if x is not False:
-            if isinstance(x, tuple):
-                if x[0] == 'single':
-                    self.code = self.code[:-2]
-                elif x[0] == 'string':
-                    x = ('string', list(x[1]))
-                    self.code = self.code[:-len(x[1])-2]
-                elif x[0] == 'number':
-                    self.code = self.code[:-x[2]]
-                else:
-                    self.code = self.code[:-len(x[1])]
-            else:
-                self.code = self.code[:-len(x)]
+            self.pos -= 1
+            if isinstance(x, tuple) and x[0] == 'string':
+                x = ('string', Text(x[1]))
         return x
 
     def peekNth(self, n):
-        ocode = self.code
-        for _ in range(n+1):
-            r = self.read()
-        self.code = ocode
-        return r
+        if n < self.pos:
+            return self.classify(self.tokens[self.pos-1-n][1])
+        return False
 
     def parseLine(self, code):
-        self.code = code
+        """Compile (through the cache) and run a line in this interpreter."""
+        return self.run(code)
+
+    def run(self, code, names=(), bindings=None):
+        """Compile (through the cache) and run a line in this interpreter,
+           binding the variables of names first, see Program.run."""
+        token = current.set(self)
+        governor = self.governor
+        if governor is not None:
+            governing.add(governor)
+        try:
+            program = compile(code, names)
+            if self.kinds(program.kinds, names) != program.kinds:
+                # A name in it has been defined or forgotten since.
+                self.cache(compile.cache).discard(code, names)
+                program = compile(code, names)
+            kind, v = program.run(bindings)
+            return (kind, tolist(v))
+        finally:
+            governing.discard(governor)
+            current.reset(token)
+
+    def value(self, res):
+        """A result of run() with a variable replaced by its value."""
+        if res[0] == 'variable':
+            return ('value', tolist(self.variables[res[1]]))
+        return res
+
+    def cache(self, c):
+        """This interpreter's copy of the cache c."""
+        try:
+            return self.caches[c.name]
+        except KeyError:
+            return self.caches.setdefault(c.name, c.copy())
+
+    def reset(self):
+        """Forget the functions and variables defined by the user, keeping
+           the caches of the primitives."""
+        if self.functions == primitives and self.variables == defaults:
+            return
+        self.functions = dict(primitives)
+        self.variables = dict(defaults)
+        for m in self.memoized:
+            del self.caches[m]
+        self.memoized.clear()
+
+    def kinds(self, names, declared=()):
+        """The syntactic types of names, with the declared ones as variables."""
+        self.names = dict.fromkeys(declared, 'variable')
+        return {n: self.classify(('name', n))[0] for n in names}
+
+    def compile(self, code, names=()):
+        """Parse a line to a Program. Names are declared as variables, so
+           they can be bound when running the program."""
+        self.tokens = tokenize(code)
         self.stack = []
-        for c in reversed(self.code):
-            if c == ')':
+        kinds = self.kinds({t[1] for _, t in self.tokens if t[0] == 'name'}, names)
+        self.instructions = []
+        for _, t in reversed(self.tokens):
+            if t == ')':
                 break
-            if c in '{(':
-                self.code += ')'
+            if t in ('{', '('):
+                self.tokens.append((len(code), ')'))
                 break
-        while len(self.code):
+        self.braces = matchBraces(self.tokens)
+        self.pos = len(self.tokens)
+        while self.pos:
             self.parseExpression()
-        return self.stack[-1]
+        return Program(code, self.instructions, self.stack[-1], kinds)
+
+    def emit(self, kind, op, *args):
+        """Record an operation to run when the program runs. Returns a stack
+           item referring to its result."""
+        self.instructions.append((op, args))
+        return (kind, Slot(len(self.instructions) - 1))
+
+    def static(self, x):
+        """Tells if a stack item is a literal known while compiling."""
+        return x[0] in ('value', 'list') and not isinstance(x[1], Slot)
 
     def parseCommon(self):
         if self.pattern(['name', 'assign', 'function']): # Function assignment
             n = self.stack.pop()[1]
             self.stack.pop()
-            f = self.stack[-1]
-            functions[n] = resolve(f)
+            self.names[n] = 'function'
+            self.emit(None, setfunction, n, self.stack[-1])
         elif self.pattern(['value', 'conjunction', 'assign', 'function']): # Assignment with conjunction
-            v = resolve(self.stack.pop())
+            v = self.stack.pop()
             c = self.stack.pop()[-1]
             a = self.stack.pop()
-            f = withConjunction(c, resolve(self.stack.pop()), v)
-            self.stack.append(('function', f))
+            f = self.stack.pop()
+            self.stack.append(self.emit('function', building(resolving(withConjunction)), c, f, v))
             self.stack.append(a)
         elif self.pattern(['adverb', 'assign', 'function']): # Assignment with an adverb
             c = self.stack.pop()[-1]
             a = self.stack.pop()
-            f = withAdverb(c, resolve(self.stack.pop()))
-            self.stack.append(('function', f))
+            f = self.stack.pop()
+            self.stack.append(self.emit('function', building(resolving(withAdverb)), c, f))
             self.stack.append(a)
         elif self.pattern(['name', 'assign', 'value']): # Value assignment
             n = self.stack.pop()[1]
             self.stack.pop()
-            v = self.stack[-1]
-            variables[n] = resolve(v)
+            self.names[n] = 'variable'
+            self.emit(None, setvariable, n, self.stack[-1])
         elif self.pattern(['adverb', 'function']): # Adverb application
             a = self.stack.pop()[1]
             f = self.stack.pop()
-            self.stack.append(('function', withAdverb(a, f)))
+            self.stack.append(self.emit('function', building(withAdverb), a, f))
         elif self.pattern(['function', 'conjunction', 'function'], ('value', 'adverb')):
-            f1 = resolve(self.stack.pop()) # 2-function conjunction application
+            f1 = self.stack.pop() # 2-function conjunction application
             c = self.stack.pop()[1]
-            f2 = resolve(self.stack.pop())
-            self.stack.append(('function', withConjunction(c, f2, f1)))
+            f2 = self.stack.pop()
+            self.stack.append(self.emit('function', building(resolving(withConjunction)), c, f2, f1))
         elif self.pattern(['value', 'conjunction', 'function'], ('value',)):
-            v = resolve(self.stack.pop()) # value-function conjunction application
+            v = self.stack.pop() # value-function conjunction application
             c = self.stack.pop()[1]
-            f = resolve(self.stack.pop())
-            self.stack.append(('function', withConjunction(c, f, v)))
+            f = self.stack.pop()
+            self.stack.append(self.emit('function', building(resolving(withConjunction)), c, f, v))
         elif self.pattern(['value', 'list']): # prepend a value to a list (basically a cheat to build lists)
-            v = resolve(self.stack.pop())
-            l = self.stack.pop()[1]
-            self.stack.append(('list', [v] + l))
+            v = self.stack.pop()
+            l = self.stack.pop()
+            if self.static(v) and self.static(l):
+                self.stack.append(('list', shaped([v[1]] + l[1])))
+            else:
+                self.stack.append(self.emit('list', resolving(lambda v, l: shaped([v] + l)), v, l))
         elif self.pattern(['value', 'value']): # turn two values to a list
-            v1 = resolve(self.stack.pop())
-            v2 = resolve(self.stack.pop())
-            self.stack.append(('list', [v1, v2]))
+            v1 = self.stack.pop()
+            v2 = self.stack.pop()
+            if self.static(v1) and self.static(v2):
+                self.stack.append(('list', shaped([v1[1], v2[1]])))
+            else:
+                self.stack.append(self.emit('list', resolving(lambda v1, v2: shaped([v1, v2])), v1, v2))
         else:
             return False
         return True
@@ -729,22 +1875,22 @@ class Interpreter:
                 if self.parseCommon():
                     pass
                 elif self.pattern(['value', 'function', 'value'], ('value', 'conjunction')): # Apply a function to two values
-                    l = resolve(self.stack.pop())
+                    l = self.stack.pop()
                     f = self.stack.pop()
-                    r = resolve(self.stack.pop())
-                    self.stack.append(('value', call(f, l, r)))
+                    r = self.stack.pop()
+                    self.stack.append(self.emit('value', call, f, l, r))
                 elif self.pattern(['function', 'value'], ('value', 'adverb', 'conjunction')): # Apply a function to two values
                     f = self.stack.pop()
-                    r = resolve(self.stack.pop())
-                    self.stack.append(('value', call(f, r)))
+                    r = self.stack.pop()
+                    self.stack.append(self.emit('value', call, f, r))
                 elif self.pattern(['value', 'function'], ('value',)): # Bind a funvtion with a value
-                    v = resolve(self.stack.pop())
-                    f = resolve(self.stack.pop())
-                    self.stack.append(('function', bind(f, v)))
+                    v = self.stack.pop()
+                    f = self.stack.pop()
+                    self.stack.append(self.emit('function', building(resolving(train)), 'bind', f, v))
                 elif self.pattern(['function', 'function'], ('value', 'adverb', 'conjunction')):
-                    f1 = resolve(self.stack.pop()) # Combine two functions
-                    f2 = resolve(self.stack.pop())
-                    self.stack.append(('function', combine(f1, f2)))
+                    f1 = self.stack.pop() # Combine two functions
+                    f2 = self.stack.pop()
+                    self.stack.append(self.emit('function', building(resolving(train)), 'combine', f1, f2))
                 else:
                     if (not p or p in until) and self.overhead[0]:
                         self.stack.append(self.overhead)
@@ -768,18 +1914,18 @@ class Interpreter:
                 if self.parseCommon():
                     pass
                 elif self.pattern(['value', 'function'], ('value',)): # Bind a funvtion with a value
-                    v = resolve(self.stack.pop())
-                    f = resolve(self.stack.pop())
-                    self.stack.append(('function', bind(f, v)))
+                    v = self.stack.pop()
+                    f = self.stack.pop()
+                    self.stack.append(self.emit('function', building(resolving(train)), 'bind', f, v))
                 elif self.pattern(['function', 'function', 'function'], ('value', 'adverb', 'conjunction')):
-                    f1 = resolve(self.stack.pop())
-                    f2 = resolve(self.stack.pop())
-                    f3 = resolve(self.stack.pop())
-                    self.stack.append(('function', fork(f1, f2, f3)))
+                    f1 = self.stack.pop()
+                    f2 = self.stack.pop()
+                    f3 = self.stack.pop()
+                    self.stack.append(self.emit('function', building(resolving(train)), 'fork', f1, f2, f3))
                 elif self.pattern(['function', 'function'], ('value', 'adverb', 'conjunction', 'function')):
-                    f1 = resolve(self.stack.pop()) # Combine two functions
-                    f2 = resolve(self.stack.pop())
-                    self.stack.append(('function', combine(f1, f2)))
+                    f1 = self.stack.pop() # Combine two functions
+                    f2 = self.stack.pop()
+                    self.stack.append(self.emit('function', building(resolving(train)), 'combine', f1, f2))
                 else:
                     if (not p or p in until) and self.overhead[0]:
                         self.stack.append(self.overhead)
@@ -849,21 +1995,12 @@ class Interpreter:
         return True
 
     def findBraceType(self):
-        ocode = self.code
-        count = 0
-        while True:
-            p = self.read()
-            if p == ')':
-                count += 1
-            elif isinstance(p, str) and p in '({[':
-                count -= 1
-            if count == 0:
-                break
-        self.code = ocode
-        return p
+        return self.braces.get(self.pos-1)
 
 # TODO: Each column should have dffferent width
 def printtable(v, w=0):
+    if isinstance(v, arraytypes):
+        v = v.tolist()
     dv = depth(v)
     if dv == 0:
         print(v)
@@ -887,16 +2024,124 @@ def printtable(v, w=0):
             if i < vl-1:
                 print('\n'*(dv-2), end='')
 
+@Cache('compile', 256)
+def compile(code, names=()):
+    """Compile a line of code to a Program of the running interpreter, which
+       can be run many times. Programs are cached by their source, see
+       compile.cache, and Interpreter.run compiles them again when their
+       names have changed kinds."""
+    return current.get().compile(code, names)
+
 parser = Interpreter()
+current = contextvars.ContextVar('interpreter', default=parser)
 
 def parseLine(code):
-    return parser.parseLine(code)
+    return current.get().parseLine(code)
 
 def runLine(code):
     res = parseLine(code)
     if res[0] == 'value':
         printtable(res[1])
 
+def stream(code, lines, size=1, budgets=None):
+    """Run the last line of code on each line of input, or on each list of
+       size lines, bound to the variable L. The lines before it run once
+       first. The program is compiled once (it stays in the compile cache),
+       and the results are yielded one at a time without reading the input ahead, so any length of input
+       runs in constant memory. Each record gets a Governor of its own if
+       budgets are given."""
+    interpreter = current.get()
+    *setup, last = filter(str.strip, code.split(newline))
+    for line in setup:
+        interpreter.parseLine(line)
+    lines = (Text(l.rstrip('\r\n')) for l in lines)
+    while True:
+        record = list(itertools.islice(lines, size))
+        if not record:
+            break
+        if budgets:
+            interpreter.governor = Governor(**budgets)
+        record = record[0] if size == 1 else shaped(record)
+        yield interpreter.value(interpreter.run(last, ('L',), {'L': record}))
+
+class Server:
+    """Runs code sent over a socket in a pool of worker threads, each with
+       an interpreter of its own which stays warm between requests.
+
+       Every request is a line of JSON, {"code": ..., "id": ...}, answered
+       with a line of JSON holding the id, the kind and value of the last
+       line of the code (or an error) and the time the request took in ms.
+       Code can have several lines, which run like a file. Names the code
+       defines are forgotten after the request, compiled programs are not.
+       Budgets are the arguments of a Governor for each request, and the
+       answer tells what the request used of them."""
+    def __init__(self, workers=4, budgets=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.local = threading.local()
+        self.budgets = budgets
+
+    def interpreter(self):
+        """The interpreter of the running worker thread."""
+        if not hasattr(self.local, 'interpreter'):
+            self.local.interpreter = Interpreter()
+        return self.local.interpreter
+
+    def evaluate(self, code, response):
+        interpreter = self.interpreter()
+        if self.budgets:
+            interpreter.governor = Governor(**self.budgets)
+        try:
+            res = (None, None)
+            for line in filter(str.strip, code.split(newline)):
+                res = interpreter.parseLine(line)
+            return interpreter.value(res)
+        finally:
+            if interpreter.governor is not None:
+                response['used'] = interpreter.governor.used()
+                interpreter.governor = None
+            interpreter.reset()
+
+    def respond(self, line):
+        """Answer a request line, in a worker thread."""
+        start = time.perf_counter()
+        response = {}
+        try:
+            request = json.loads(line)
+            response['id'] = request.get('id')
+            kind, v = self.evaluate(request['code'], response)
+            response['kind'] = kind
+            response['value'] = v if kind == 'value' else None
+        except Exception as e:
+            response['error'] = '%s: %s' % (type(e).__name__, e)
+        response['ms'] = (time.perf_counter() - start) * 1000
+        return json.dumps(response, default=repr) + newline
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    writer.write((await loop.run_in_executor(self.executor, self.respond, line)).encode())
+                    await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, address):
+        """Listen at address: a path for a Unix socket, otherwise [host:]port."""
+        if '/' in address:
+            return await asyncio.start_unix_server(self.handle, address)
+        host, _, port = address.rpartition(':')
+        return await asyncio.start_server(self.handle, host or 'localhost', int(port))
+
+    def run(self, address):
+        async def serve():
+            async with await self.start(address) as server:
+                await server.serve_forever()
+        asyncio.run(serve())
+
 class REPL(cmd.Cmd):
     prompt = '   '
     intro = "Joe REPL - Version " + version + "\nType exit to quit."
@@ -914,6 +2159,17 @@ class REPL(cmd.Cmd):
             else:
                 DEBUG = False
                 print("debug output off.")
+        elif code.split()[:1] == ['cache']:
+            args = code.split()[1:]
+            if args == ['clear']:
+                clearcaches()
+                print("Caches cleared.")
+            elif len(args) == 2 and args[0] == 'size':
+                sizecaches(None if args[1] == 'inf' else int(args[1]))
+                print("Cache size set to " + args[1] + ".")
+            else:
+                for c in current.get().caches.values():
+                    print(c)
         elif code.strip() != '':
             try:
                 v = runLine(code)
@@ -925,29 +2181,58 @@ class REPL(cmd.Cmd):
 
 if __name__ == '__main__':
     tablemode = '-t' in sys.argv
+    if '-cs' in sys.argv:
+        n = sys.argv[sys.argv.index('-cs')+1]
+        CACHESIZE = None if n == 'inf' else int(n)
+        sizecaches(CACHESIZE)
     if '-nm' in sys.argv:
-        memoize = memoizef = usermemoize = lambda f: f
+        sizecaches(0)
     else:
-        if '-mf' not in sys.argv:
-            usermemoize = lambda f: f
+        MEMOIZE = '-mf' in sys.argv and '-nmc' not in sys.argv
         if '-nmc' in sys.argv:
-            memoize = lambda f: f
+            sizecaches(0, True)
         if '-nms' in sys.argv:
-            memoizef = lambda f: f
+            sizecaches(0, False)
     if '-debug' in sys.argv:
         DEBUG = True
+    if '-closures' in sys.argv:
+        TRAINS = 'closures'
+    if '-na' in sys.argv:
+        numpy = None
+    if '-p' in sys.argv:
+        PROCESSES = int(sys.argv[sys.argv.index('-p')+1])
+    if '-pt' in sys.argv:
+        PARALLEL = int(sys.argv[sys.argv.index('-pt')+1])
+    budgets = {}
+    for flag, budget, kind in (('-bc', 'calls', int), ('-be', 'elements', int), ('-bt', 'seconds', float)):
+        if flag in sys.argv:
+            budgets[budget] = kind(sys.argv[sys.argv.index(flag)+1])
     if '-h' in sys.argv or '--help' in sys.argv or len(sys.argv) == 1:
         print("Joe Interpreter - Version " + version)
-        print("Uses python 3 and arpeggio module. Install with pip install arpeggio.")
+        print("Uses python 3.")
         print()
         print("  python joe.py [options] (-c code | file)")
         print("    -h     show this help")
-        print("    -mf    memoize user-defined functions (prevents changing output)")
+        print("    -mf    memoize pure user-defined functions (ones not using ?, Pr or variables)")
         print("    -nm    prevents all memoization")
         print("    -nmc   prevents complex memoization")
         print("    -nms   prevents simple memoization")
+        print("    -cs N  keep at most N entries in each memo cache (inf for no limit)")
         print("    -repl  starts REPL")
+        print("    -serve A   run code sent as lines of JSON to a Unix socket path or [host:]port")
+        print("    -w N   evaluate in N worker threads when serving (default 4)")
         print("    -debug Enables debug output")
+        print("    -closures  run trains as nested closures instead of the train VM")
+        print("    -na    don't use NumPy arrays even if NumPy is installed")
+        print("    -p N   map pure functions over long lists in N worker processes")
+        print("    -pt N  map lists of at least N items in parallel (default 1024)")
+        print("    -s     run the last line of the code on each line of input, bound to L")
+        print("    -n N   with -s, bind L to lists of N lines instead")
+        print("    -i F   with -s, read the input from file F instead of stdin")
+        print("    -bc N  stop after N function calls")
+        print("    -be N  stop after allocating N list items")
+        print("    -bt S  stop after S seconds")
+        print("    -bench run the benchmarks with both train engines")
         print("    -test  run after making changes to the interpreter to check damages")
     elif '-test' in sys.argv:
         fails = []
@@ -972,16 +2257,38 @@ if __name__ == '__main__':
                 print()
         else:
             print("Everything works.")
+    elif '-bench' in sys.argv:
+        for c in benchmarks:
+            print("  Code:", c)
+            for TRAINS in ('closures', 'vm'):
+                t = timeit.timeit(lambda: parseLine(c), number=10) / 10
+                print("    {:9} {:8.2f} ms".format(TRAINS, t * 1000))
     elif '-repl' in sys.argv:
         REPL().cmdloop()
+    elif '-serve' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('-w')+1]) if '-w' in sys.argv else 4
+        Server(workers, budgets).run(sys.argv[sys.argv.index('-serve')+1])
     else:
         if '-c' in sys.argv:
             code = sys.argv[sys.argv.index('-c')+1]
-        tree = parser.parse(code)
-        if '-ast' in sys.argv:
-            pprint(visit_parse_tree(tree, SyntaxVisitor()))
         else:
-            v = visit_parse_tree(tree, InterpreterVisitor())
-            printtable(v[-1])
+            with open(sys.argv[-1]) as f:
+                code = f.read()
+        if '-s' in sys.argv:
+            size = int(sys.argv[sys.argv.index('-n')+1]) if '-n' in sys.argv else 1
+            f = open(sys.argv[sys.argv.index('-i')+1]) if '-i' in sys.argv else sys.stdin
+            with f:
+                for res in stream(code, f, size, budgets):
+                    if res[0] == 'value':
+                        printtable(res[1])
+                    sys.stdout.flush()
+        else:
+            if budgets:
+                parser.governor = Governor(**budgets)
+            for line in filter(str.strip, code.split(newline)):
+                res = parseLine(line)
+            res = parser.value(res)
+            if res[0] == 'value':
+                printtable(res[1])
 
 